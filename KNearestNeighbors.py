@@ -2,26 +2,193 @@
 
 # Author: Ayman Shahriar <ayman.shahriar@ucalgary.ca>
 
+import contextlib
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
-from collections import Counter
+from scipy.spatial import cKDTree
+
+try:
+    import numba
+    from numba import njit, prange
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# Most features for which the brute-force search uses the numba kernel below (if numba is installed), which computes
+# distances and keeps the nearest neighbors in a single pass over the training data. With few features, selecting the
+# neighbors from each block of the distance matrix costs more than the matrix product itself, and the kernel is faster
+# (about 8x with 1 feature, 2x with 8, even with 12 and slower beyond that, whatever the number of datapoints).
+# It is compiled on its first call for each number of features, which takes about a second.
+_NUMBA_MAX_FEATURES = 8
+
+# Most bytes of the distance matrix the GPU search builds at once.
+_MAX_DISTANCE_MATRIX_BYTES = 256 * 1024 ** 2
 
+# Number of distances computed per block in the brute-force search (1 MB of float64),
+# so that each block of the distance matrix is still in cache when its nearest neighbors are selected.
+_DISTANCE_BLOCK_SIZE = 131072
 
-class MyKNeighborsClassifier:
+# Most training datapoints per block. The blocks span a range of the test rows and a range of the training rows,
+# so their size stays within _DISTANCE_BLOCK_SIZE however large the training set is, while still having enough test
+# rows for the matrix product to run efficiently.
+_DISTANCE_BLOCK_COLUMNS = 1024
+
+# Predictions only run on the GPU when both the training and the test datapoints have at least this many rows.
+# Below that, copying the data to the device costs more than the computation it saves.
+_GPU_MIN_ROWS = 512
+
+# With algorithm='auto', a KD-tree is only built up to this many features.
+# Past that, a tree prunes too few branches to beat the brute-force search.
+_KD_TREE_MAX_FEATURES = 15
+
+
+def _effective_n_jobs(n_jobs):
     """
-    Classifier that predicts the class of the unknown datapoint to be the most common class of its k nearest neighbors
+    Turn an n_jobs setting into a number of threads.
+    None means a single thread, and negative values count back from the number of cores (-1 means all of them).
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs == 0:
+        raise ValueError("n_jobs == 0 has no meaning, use a positive number of threads, or -1 for all cores")
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return n_jobs
+
+
+if _NUMBA_AVAILABLE:
+    @functools.lru_cache(maxsize=None)
+    def _make_kneighbors_kernel(num_features):
+        """
+        Build a numba kernel that finds nearest neighbors, specialized for a fixed number of features.
+        num_features is a compile-time constant inside the kernel, so LLVM can fully unroll and vectorize the
+        distance loop. Kernels are cached per number of features, and each one is compiled on its first call.
 
-    Attributes
-    ----------
-    k : Number of nearest neighbors to use in the algorithm
-    X_train : 2d numpy array containing the features of all neighbors, where each row contains the features of a single neighbor
-    y_train : 1d numpy array containing the target of each neighbor
+        Parameters
+        __________
+        num_features : number of features (columns) of the datapoints the kernel will be called on
+
+        Returns
+        -------
+        kneighbors_kernel : jitted function(X_test, X_train, k) returning the k nearest neighbors of every test row
+        """
+        @njit(parallel=True, fastmath=True)
+        def kneighbors_kernel(X_test, X_train, k):
+            """
+            Find the k nearest training datapoints of every test datapoint, one test row per thread.
+            Each row's neighbors are kept in a max-heap of size k, so only O(k) memory is used per test datapoint.
+
+            Parameters
+            __________
+            X_test : 2d float matrix of the datapoints whose neighbors we want
+            X_train : 2d float matrix of the candidate neighbors
+            k : number of neighbors to find
+
+            Returns
+            -------
+            heap_distances : 2d matrix with the squared distances to the k nearest neighbors of each test datapoint
+            heap_indices : 2d matrix with the indices (in X_train) of the k nearest neighbors of each test datapoint
+            """
+            num_test = X_test.shape[0]
+            num_train = X_train.shape[0]
+            heap_distances = np.empty((num_test, k), dtype=np.float64)
+            heap_indices = np.empty((num_test, k), dtype=np.intp)
+            for i in prange(num_test):
+                distances = heap_distances[i]
+                indices = heap_indices[i]
+                size = 0
+                for j in range(num_train):
+                    squared_distance = 0.0
+                    for f in range(num_features):
+                        # In float64 even for float32 datapoints, like the distances of the other searches
+                        difference = np.float64(X_test[i, f]) - np.float64(X_train[j, f])
+                        squared_distance += difference * difference
+
+                    if size < k:
+                        # Heap not full yet: sift the new neighbor up from the bottom
+                        position = size
+                        size += 1
+                        while position > 0:
+                            parent = (position - 1) // 2
+                            if distances[parent] >= squared_distance:
+                                break
+                            distances[position] = distances[parent]
+                            indices[position] = indices[parent]
+                            position = parent
+                        distances[position] = squared_distance
+                        indices[position] = j
+                    elif squared_distance < distances[0]:
+                        # Closer than the farthest kept neighbor: replace the root and sift it down
+                        position = 0
+                        while True:
+                            child = 2 * position + 1
+                            if child >= k:
+                                break
+                            if child + 1 < k and distances[child + 1] > distances[child]:
+                                child += 1
+                            if distances[child] <= squared_distance:
+                                break
+                            distances[position] = distances[child]
+                            indices[position] = indices[child]
+                            position = child
+                        distances[position] = squared_distance
+                        indices[position] = j
+            return heap_distances, heap_indices
+
+        return kneighbors_kernel
+
+
+class _KNNBase:
+    """
+    Shared implementation of the K-Nearest Neighbor models: storing the neighbors and searching for the nearest ones.
+    The models only differ in how they combine the targets of the k nearest neighbors, see _aggregate.
     """
-    def __init__(self, k=5):
+    def __init__(self, k=5, algorithm='auto', n_jobs=-1, dtype=np.float64, device='cpu'):
         self.k = k
         self.X_train = None
         self.y_train = None
+        self.algorithm = algorithm
+        self.n_jobs = n_jobs
+        self.dtype = dtype
+        self.device = device
+        self._tree = None
+        self._min = None
+        self._scale = None
+        self._X_train_squared_norms = None
+        self._kneighbors_kernel = None
+        self._difference_buffer = None
+        self._squared_distances_buffer = None
+        self._X_train_gpu = None
+
+    def _sq_distance(self, datapointA, datapointB):
+        """
+        Get the squared distance between two n-dimensional points
+        (assume they are 1d arrays only containing the features, not target).
+        Finding the nearest neighbors only needs to compare distances, so the square root can be skipped.
 
+        Parameters
+        __________
+        datapointA : the features of the first datapoint
+        datapointB : the features of the second datapoint
+
+        Returns
+        -------
+        squared_distance : the squared distance between the two datapoints
+        """
+        # Subtracting in float64 means integer features can neither overflow nor get truncated.
+        difference = np.subtract(datapointA, datapointB, dtype=np.float64)
+        # A dot product of the difference with itself is a single BLAS call, and float() returns a plain Python number.
+        squared_distance = float(np.dot(difference, difference))
+        return squared_distance
 
     def get_distance(self, datapointA, datapointB):
         """
@@ -37,18 +204,40 @@ class MyKNeighborsClassifier:
         -------
         distance : the distance between the two datapoints
         """
-        # If using numpy arrays, make sure to set data type to int64 to prevent overflow. By default its int32
-        # Instead, I just converted to lists, keeps things simple. Besides, int64 cannot handle decimals.
-        datapointA = list(datapointA)
-        datapointB = list(datapointB)
-        sum_squared_diff = 0
-
-        for featureA, featureB in zip(datapointA, datapointB):
-            squared_diff = (featureA - featureB) ** 2
-            sum_squared_diff += squared_diff
-        distance = sum_squared_diff ** 0.5
+        distance = np.sqrt(self._sq_distance(datapointA, datapointB))
         return distance
 
+    def _pairwise_sqeuclidean(self, A, B, B_squared_norms=None):
+        """
+        Get the squared distance between every row of A and every row of B.
+        Uses the expansion ||a-b||^2 = ||a||^2 + ||b||^2 - 2a.b, so the bulk of the work is a single matrix product.
+        Lower precision features are upcast to float64 first: in float32 the expansion cancels out the distances between
+        close points.
+
+        Parameters
+        __________
+        A : a 2d matrix of features, where each row corresponds to the features of a single datapoint
+        B : a 2d matrix of features, where each row corresponds to the features of a single datapoint
+        B_squared_norms : the squared norm (in float64) of every row of B, if already known (e.g. cached in fit)
+
+        Returns
+        -------
+        squared_distances : 2d matrix where the value at [i, j] is the squared distance between A[i] and B[j]
+        """
+        A = np.asarray(A, dtype=np.float64)
+        B = np.asarray(B, dtype=np.float64)
+        if B_squared_norms is None:
+            B_squared_norms = np.einsum('ij,ij->i', B, B)
+        A_squared_norms = np.einsum('ij,ij->i', A, A)
+        # Build the result in place on top of the matrix product, to avoid extra M x N temporaries
+        squared_distances = A @ B.T
+        squared_distances *= -2.0
+        squared_distances += A_squared_norms[:, None]
+        squared_distances += B_squared_norms[None, :]
+        # Rounding errors can make the distance between (nearly) identical points slightly negative
+        np.maximum(squared_distances, 0, out=squared_distances)
+        return squared_distances
+
     def minmax_normalize(self, X):
         """
         Sets the min to be 0 and max to be 1. The other numbers will transform to values between 0 and 1, depending on their distance from the min and max.
@@ -61,23 +250,36 @@ class MyKNeighborsClassifier:
         -------
         minmax_normalized_X : the minmax-normalized version of the 2d matrix of features
         """
-        # In order to loop through each column, just loop through the transposed matrix
-        # A transposed matrix is just a new matrix where the rows of original matrix are columns and vice versa.
-        transposed_X = zip(*X)
-        normalized_features = []
-        for feature in transposed_X:
-            normalized_feature = []
-            minimum = min(feature)
-            maximum = max(feature)
-            for value in feature:
-                normalized_value = (value-minimum)/(maximum-minimum)
-                normalized_feature.append(normalized_value)
-            normalized_features.append(normalized_feature)
-        # Transpose again to make sure each row corresponds to the features of a single datapoint
-        minmax_normalized_X = np.array(list(zip(*normalized_features)))
+        # Get the min and max of each column (feature) with reductions along the rows.
+        X = np.asarray(X, dtype=np.float64)
+        minimum = X.min(axis=0)
+        maximum = X.max(axis=0)
+        # A constant column has no range, map it to 0 instead of dividing by zero.
+        value_range = np.where(maximum == minimum, 1.0, maximum - minimum)
+        minmax_normalized_X = (X - minimum) / value_range
         return minmax_normalized_X
 
-    def fit(self, X_train, y_train):
+    def _scale_features(self, X):
+        """
+        Applies the minmax-normalization learned in fit (if any) to a matrix of features or a single datapoint.
+
+        Parameters
+        __________
+        X : a 2d matrix of features, or the 1d features of a single datapoint
+
+        Returns
+        -------
+        scaled_X : array of type self.dtype with the same shape as X
+        """
+        scaled_X = np.asarray(X, dtype=self.dtype)
+        if self._min is None:
+            return scaled_X
+        # Subtract into a new array, then scale it in place, so only one temporary is made.
+        scaled_X = np.subtract(scaled_X, self._min)
+        np.multiply(scaled_X, self._scale, out=scaled_X)
+        return scaled_X
+
+    def fit(self, X_train, y_train, normalize=False):
         """
         Sets the neighbors that will be used in the algorithm
 
@@ -85,15 +287,60 @@ class MyKNeighborsClassifier:
         __________
         X_train : a 2d matrix of features, where each row corresponds to the features of a single datapoint.
         y_train: a 1d matrix of targets, where each value corresponts to the target of a single datapoint
+        normalize: if True, minmax-normalize X_train and remember its min and range,
+                   so that the datapoints to predict get the exact same transformation.
         """
-        self.X_train = X_train
-        self.y_train = y_train
+        X_train = np.asarray(X_train, dtype=np.float64)
+        # Every search below needs at least k candidates, so catch this here instead of deep inside one of them
+        if not 1 <= self.k <= X_train.shape[0]:
+            raise ValueError("k must be between 1 and the number of training datapoints (%d), got %r"
+                             % (X_train.shape[0], self.k))
+        if normalize:
+            minimum = X_train.min(axis=0)
+            value_range = X_train.max(axis=0) - minimum
+            # A constant column has no range, map it to 0 instead of dividing by zero.
+            self._min = minimum.astype(self.dtype)
+            self._scale = (1.0 / np.where(value_range == 0, 1.0, value_range)).astype(self.dtype)
+            X_train = self._scale_features(X_train)
+        else:
+            self._min = None
+            self._scale = None
+        # Store the features once as a contiguous matrix of self.dtype, so every prediction can subtract from it directly.
+        self.X_train = np.ascontiguousarray(X_train, dtype=self.dtype)
+        self.y_train = np.asarray(y_train)
+        # The squared norms of the training datapoints never change, so the brute-force search computes them only once
+        self._X_train_squared_norms = np.einsum('ij,ij->i', self.X_train, self.X_train, dtype=np.float64)
+        # Scratch space for predict_single_datapoint, allocated on its first call, so drop the old one
+        self._difference_buffer = None
+        self._squared_distances_buffer = None
+        # The number of features is fixed from now on, so get a numba kernel specialized for it
+        self._kneighbors_kernel = _make_kneighbors_kernel(self.X_train.shape[1]) if _NUMBA_AVAILABLE else None
+        # Upload the training datapoints once, if predictions can run on the GPU
+        if self.device != 'cpu' and self.X_train.shape[0] >= _GPU_MIN_ROWS:
+            import torch
+            # In float64 whatever self.dtype is: like _pairwise_sqeuclidean, torch.cdist uses the matrix-product expansion,
+            # which is too inaccurate in float32 to order close neighbors
+            self._X_train_gpu = torch.as_tensor(self.X_train, dtype=torch.float64, device=self.device)
+        else:
+            self._X_train_gpu = None
+
+        algorithm = self.algorithm
+        if algorithm == 'auto':
+            algorithm = 'kd_tree' if self.X_train.shape[1] <= _KD_TREE_MAX_FEATURES else 'brute'
+        if algorithm == 'kd_tree':
+            self._tree = cKDTree(self.X_train)
+        elif algorithm == 'ball_tree':
+            from sklearn.neighbors import BallTree
+            self._tree = BallTree(self.X_train)
+        elif algorithm == 'brute':
+            self._tree = None
+        else:
+            raise ValueError("algorithm must be 'auto', 'brute', 'kd_tree' or 'ball_tree', got %r" % (self.algorithm,))
 
     def predict_single_datapoint(self, unknown):
         """
         Uses K-Nearest Neighbors algorithm to predict the target for a single datapoint.
-        For an unknown datapoint, find its nearest k neighbors.
-        Classify the new point based on those neighbors.
+        For an unknown datapoint, find its nearest k neighbors, and combine their targets into the prediction.
 
         Parameters
         __________
@@ -101,163 +348,205 @@ class MyKNeighborsClassifier:
 
         Returns
         _______
-        most_common_class: the predicted target for the datapoint.
-                           This predicted target will be the most common target among the datapoint's k nearest neighbors
-        """
-        # Find the distance between this datapoint and every other datapoint.
-        # Distances is a 2d array, storing [distance, target] of each datapoint.
-        distances = []
-        for known_datapoint, target in zip(self.X_train, self.y_train):
-            distance = self.get_distance(unknown, known_datapoint)
-            distances.append([distance, target])
-        # Sort the distances, return the distance. By default, I think a 2d array will be sorted by the first element
-        # in the subarray.
-        distances.sort()
-        neighbors = distances[0:self.k]
-        # Now count the most common class/category among the neighbors, and that will be our predicted category
-        # for the unknown datapoint.
-        neighbors_features = [x[1] for x in neighbors]
-        counter = Counter(neighbors_features)
-        most_common_class = counter.most_common(1)[0][0]
-        return most_common_class
-
-    def predict(self, X_test):
+        predicted_target: the predicted target for the datapoint.
         """
-        Uses K-Nearest Neighbors algorithm to predict the targets of multiple datapoints.
+        # Find the squared distance between this datapoint and every other datapoint in one vectorized pass.
+        # The square root is skipped, since it does not change which neighbors are the nearest.
+        # Both steps write into the same buffers on every call, so no N x D temporary is created per call.
+        # They are only allocated here, so models that only use predict do not pay for them.
+        if self._difference_buffer is None:
+            self._difference_buffer = np.empty_like(self.X_train)
+            self._squared_distances_buffer = np.empty(self.X_train.shape[0], dtype=self.X_train.dtype)
+        np.subtract(self.X_train, self._scale_features(unknown)[None, :], out=self._difference_buffer)
+        squared_distances = np.einsum('ij,ij->i', self._difference_buffer, self._difference_buffer,
+                                      out=self._squared_distances_buffer)
+        # Select the k nearest neighbors in linear time, instead of sorting all the distances.
+        neighbor_indices = np.argpartition(squared_distances, self.k - 1)[:self.k]
+        # Combine the neighbors the same way predict does, as a batch of a single datapoint
+        predicted_target = self._aggregate(self.y_train[neighbor_indices][None, :],
+                                           squared_distances[neighbor_indices][None, :])[0]
+        return predicted_target
+
+    def _kneighbors(self, X_test):
+        """
+        Find the k nearest neighbors of multiple datapoints.
+        Large enough workloads run on the GPU if a device was given. Otherwise, if a tree was built in fit, it is queried.
+        Without a tree, datapoints with few features use the numba kernel (if numba is installed) and the others use a
+        blocked brute-force search.
 
         Parameters
         __________
-        X_test: 2d matrix of features, where each row corresponts to the features of a single datapoint
+        X_test: 2d matrix of features, where each row corresponds to the features of a single datapoint
 
         Returns
         _______
-        y_pred: 1d array of targets predicted for each datapoint
+        neighbors_squared_distances: 2d matrix with the squared distances to the k nearest neighbors of each datapoint
+        neighbor_indices: 2d matrix with the indices (in X_train) of the k nearest neighbors of each datapoint
         """
-        y_pred = []
-        for unknown_datapoint in X_test:
-            predicted_target = self.predict_single_datapoint(unknown_datapoint)
-            y_pred.append(predicted_target)
-        return np.array(y_pred)
-
-
-class MyKNeighborsRegressor:
-    """
-    Regression model that predicts the target of the unknown datapoint to be the average target of its k nearest neighbors
-
-    Attributes
-    ----------
-    k : Number of nearest neighbors to use in the algorithm.
-    X_train : 2d numpy array containing the features of all neighbors, where each row contains the features of a single neighbor.
-    y_train : 1d numpy array containing the target of each neighbor.
-    weighted: Indicated whether or not we will compute the weighted average of the k neighbors or just the regular mean of
-              the k neighbors.
-    """
+        X_test = np.ascontiguousarray(self._scale_features(X_test))
+        # Nothing to search for. Answer here, since not every algorithm accepts an empty query (e.g. BallTree raises)
+        if X_test.shape[0] == 0:
+            return np.empty((0, self.k), dtype=np.float64), np.empty((0, self.k), dtype=np.intp)
+        if self._X_train_gpu is not None and X_test.shape[0] >= _GPU_MIN_ROWS:
+            return self._kneighbors_gpu(X_test)
+        n_threads = _effective_n_jobs(self.n_jobs)
+        if isinstance(self._tree, cKDTree):
+            neighbors_distances, neighbor_indices = self._tree.query(X_test, k=self.k, workers=n_threads)
+            # With k=1 the tree returns 1d arrays, keep one row per test datapoint
+            neighbors_distances = neighbors_distances.reshape(len(X_test), self.k)
+            neighbor_indices = neighbor_indices.reshape(len(X_test), self.k)
+            return neighbors_distances ** 2, neighbor_indices
+        if self._tree is not None:
+            neighbors_distances, neighbor_indices = self._tree.query(X_test, k=self.k)
+            return neighbors_distances ** 2, neighbor_indices
+
+        if self._kneighbors_kernel is not None and self.X_train.shape[1] <= _NUMBA_MAX_FEATURES:
+            # The kernel's prange loop runs on numba's own threads, so limit those to n_jobs for this call
+            previous_n_threads = numba.get_num_threads()
+            numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+            try:
+                return self._kneighbors_kernel(X_test, self.X_train, self.k)
+            finally:
+                numba.set_num_threads(previous_n_threads)
+
+        neighbors_squared_distances = np.empty((X_test.shape[0], self.k), dtype=np.float64)
+        neighbor_indices = np.empty((X_test.shape[0], self.k), dtype=np.intp)
+        block_rows, _ = self._brute_block_shape()
+        n_threads = min(n_threads, -(-X_test.shape[0] // block_rows))
+        if n_threads <= 1:
+            self._kneighbors_brute(X_test, neighbors_squared_distances, neighbor_indices)
+            return neighbors_squared_distances, neighbor_indices
+
+        # Give each thread one contiguous range of test datapoints rather than one task per block, to keep the
+        # scheduling overhead low. NumPy releases the GIL while computing, so the threads do run in parallel.
+        # The matrix products would otherwise each use a multithreaded BLAS, starting about n_threads * cores threads.
+        # threadpool_limits sets the BLAS limit for the whole process, so other threads' BLAS calls are also limited
+        # until the search is done.
+        bounds = np.linspace(0, X_test.shape[0], n_threads + 1).astype(int)
+        blas_limit = threadpool_limits(limits=1, user_api='blas') if threadpool_limits is not None \
+            else contextlib.nullcontext()
+        with blas_limit, ThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = [executor.submit(self._kneighbors_brute, X_test[start:stop],
+                                       neighbors_squared_distances[start:stop], neighbor_indices[start:stop])
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+        return neighbors_squared_distances, neighbor_indices
+
+    def _kneighbors_gpu(self, X_test):
+        """
+        Brute-force search for the k nearest neighbors of multiple datapoints on the GPU, using PyTorch.
 
-    def __init__(self, k=5, weighted=True):
-        self.k = k
-        self.X_train = None
-        self.y_train = None
-        self.weighted = weighted
+        Parameters
+        __________
+        X_test: 2d matrix of (already scaled) features of the same type as X_train, where each row is a single datapoint
 
-    def get_distance(self, datapointA, datapointB):
+        Returns
+        _______
+        neighbors_squared_distances: 2d matrix with the squared distances to the k nearest neighbors of each datapoint
+        neighbor_indices: 2d matrix with the indices (in X_train) of the k nearest neighbors of each datapoint
         """
-        Get distance between two n-dimensional points
-        (assume they are 1d arrays only containing the features, not target)
+        import torch
+        neighbors_squared_distances = np.empty((X_test.shape[0], self.k), dtype=np.float64)
+        neighbor_indices = np.empty((X_test.shape[0], self.k), dtype=np.intp)
+        # Send the test datapoints in blocks, so the distance matrix on the device stays within the memory budget.
+        block_rows = max(1, _MAX_DISTANCE_MATRIX_BYTES // (self.X_train.shape[0] * self._X_train_gpu.element_size()))
+        for start in range(0, X_test.shape[0], block_rows):
+            stop = start + block_rows
+            X_block = torch.as_tensor(X_test[start:stop], dtype=torch.float64, device=self.device)
+            # torch.cdist only needs to get the order of the neighbors right, their distances are recomputed exactly below
+            distance_matrix = torch.cdist(X_block, self._X_train_gpu)
+            _, block_indices = torch.topk(distance_matrix, self.k, dim=1, largest=False)
+            neighbor_indices[start:stop] = block_indices.cpu().numpy()
+            neighbors_squared_distances[start:stop] = self._exact_squared_distances(X_test[start:stop],
+                                                                                    neighbor_indices[start:stop])
+        return neighbors_squared_distances, neighbor_indices
+
+    def _kneighbors_brute(self, X_test, neighbors_squared_distances, neighbor_indices):
+        """
+        Brute-force search for the k nearest neighbors of multiple datapoints, writing the results into the given arrays.
 
         Parameters
         __________
-        datapointA : the features of the first datapoint
-        datapointB : the features of the second datapoint
+        X_test: 2d matrix of (already scaled) features of the same type as X_train, where each row is a single datapoint
+        neighbors_squared_distances: 2d matrix to fill with the squared distances to the k nearest neighbors
+        neighbor_indices: 2d matrix to fill with the indices (in X_train) of the k nearest neighbors
+        """
+        # Go through the distance matrix a block at a time, so it is never built in full: for each block of test rows,
+        # go through the training datapoints a block of rows at a time and keep the k nearest found so far.
+        block_rows, block_columns = self._brute_block_shape()
+        for start in range(0, X_test.shape[0], block_rows):
+            stop = start + block_rows
+            block_distances, block_indices = None, None
+            for train_start in range(0, self.X_train.shape[0], block_columns):
+                train_stop = train_start + block_columns
+                # Squared distance between every test datapoint in the block and every training datapoint in the block.
+                # Each row of the distance matrix corresponds to a single test datapoint.
+                distance_matrix = self._pairwise_sqeuclidean(X_test[start:stop], self.X_train[train_start:train_stop],
+                                                             self._X_train_squared_norms[train_start:train_stop])
+                # Get the k nearest training datapoints in the block for each test datapoint, without sorting the rows.
+                nearest = np.argpartition(distance_matrix, min(self.k, distance_matrix.shape[1]) - 1, axis=1)[:, :self.k]
+                candidate_distances = np.take_along_axis(distance_matrix, nearest, axis=1)
+                candidate_indices = nearest + train_start
+                if block_distances is not None:
+                    # Keep the k nearest of these and of the ones found in the previous training blocks
+                    candidate_distances = np.concatenate([block_distances, candidate_distances], axis=1)
+                    candidate_indices = np.concatenate([block_indices, candidate_indices], axis=1)
+                    nearest = np.argpartition(candidate_distances, self.k - 1, axis=1)[:, :self.k]
+                    candidate_distances = np.take_along_axis(candidate_distances, nearest, axis=1)
+                    candidate_indices = np.take_along_axis(candidate_indices, nearest, axis=1)
+                block_distances, block_indices = candidate_distances, candidate_indices
+            neighbor_indices[start:stop] = block_indices
+            neighbors_squared_distances[start:stop] = self._exact_squared_distances(X_test[start:stop], block_indices)
+
+    def _brute_block_shape(self):
+        """
+        Number of test rows and of training rows in each block of the brute-force search.
+        A block has at least k training rows, so that the first one already holds k candidates for each test datapoint.
 
         Returns
-        -------
-        distance : the distance between the two datapoints
+        _______
+        block_rows: number of test datapoints per block
+        block_columns: number of training datapoints per block
         """
-        # If using numpy arrays, make sure data type to int64 to prevent overflow. By default its int32
-        # Instead, I just converted to lists, keeps things simple. Besides, int64 cannot handle decimals.
-        datapointA = list(datapointA)
-        datapointB = list(datapointB)
-        sum_squared_diff = 0
+        block_columns = min(self.X_train.shape[0], max(self.k, _DISTANCE_BLOCK_COLUMNS))
+        block_rows = max(1, _DISTANCE_BLOCK_SIZE // block_columns)
+        return block_rows, block_columns
 
-        for featureA, featureB in zip(datapointA, datapointB):
-            squared_diff = (featureA - featureB) ** 2
-            sum_squared_diff += squared_diff
-        distance = sum_squared_diff ** 0.5
-        return distance
-
-    def minmax_normalize(self, X):
+    def _exact_squared_distances(self, X_test, neighbor_indices):
         """
-        Sets the min to be 0 and max to be 1. The other numbers will transform to values between 0 and 1, depending on their distance from the min and max.
+        Recompute the squared distances to the selected neighbors directly from their differences.
+        The brute-force searches are fast but inexact: the matrix-product expansion (and torch.cdist) can turn a distance
+        of exactly 0 into a tiny positive number, which would change the weighted average. This only costs O(k*D) per row.
 
         Parameters
         __________
-        X : a 2d matrix of features, where each row corresponds to the features of a single datapoint.
+        X_test: 2d matrix of (already scaled) features, where each row corresponds to a single datapoint
+        neighbor_indices: 2d matrix with the indices (in X_train) of the k nearest neighbors of each datapoint
 
         Returns
-        -------
-        minmax_normalized_X : the minmax-normalized version of the 2d matrix of features
+        _______
+        neighbors_squared_distances: 2d float64 matrix with the squared distances to the k nearest neighbors
         """
-        # In order to loop through each column, just loop through the transposed matrix
-        # A transposed matrix is just a new matrix where the rows of original matrix are columns and vice versa.
-        transposed_X = zip(*X)
-        normalized_features = []
-        for feature in transposed_X:
-            normalized_feature = []
-            minimum = min(feature)
-            maximum = max(feature)
-            for value in feature:
-                normalized_value = (value-minimum)/(maximum-minimum)
-                normalized_feature.append(normalized_value)
-            normalized_features.append(normalized_feature)
-        # Transpose again to make sure each row corresponds to the features of a single datapoint
-        minmax_normalized_X = np.array(list(zip(*normalized_features)))
-        return minmax_normalized_X
+        difference = np.subtract(X_test[:, None, :], self.X_train[neighbor_indices], dtype=np.float64)
+        neighbors_squared_distances = np.einsum('ijk,ijk->ij', difference, difference)
+        return neighbors_squared_distances
 
-    def fit(self, X_train, y_train):
-        self.X_train = X_train
-        self.y_train = y_train
-
-    def predict_single_datapoint(self, unknown):
+    def _aggregate(self, neighbors_targets, neighbors_squared_distances):
         """
-        Uses K-Nearest Neighbors algorithm to predict the target for a single datapoint.
+        Combines the targets of the k nearest neighbors of multiple datapoints into their predicted targets.
+        Implemented by each model.
 
         Parameters
         __________
-        unknown: the datapoint whose target we want to predict.
+        neighbors_targets: 2d matrix with the targets of the k nearest neighbors of each datapoint
+        neighbors_squared_distances: 2d matrix with the squared distances to the k nearest neighbors of each datapoint
 
         Returns
         _______
-        predicted_target: the predicted target for the datapoint.
-                          This predicted target will be the average target of the datapoint's k nearest neighbors.
-        """
-        # Find the distance between this datapoint and every other datapoint.
-        # Distances is a 2d array, storing [distance, target] of each datapoint.
-        distances = []
-        for known_datapoint, target in zip(self.X_train, self.y_train):
-            distance = self.get_distance(unknown, known_datapoint)
-            distances.append([distance, target])
-        # Sort the distances, return the distance. By default, I think a 2d array will be sorted by the first element
-        # in the subarray.
-        distances.sort()
-        neighbors = distances[0:self.k]
-
-        if self.weighted:
-            numerator = 0
-            denominator = 0
-            for neighbor in neighbors:
-                distance = neighbor[0]
-                target = neighbor[1]
-                numerator += target/distance
-                denominator += 1/distance
-            weighted_mean = numerator/denominator
-            return weighted_mean
-        else:
-        # Now get the average of the neighbor's targets, that will be our predicted target for the unlabelled datapoint
-            sum_neighbor_targets = 0
-            for neighbor in neighbors:
-                sum_neighbor_targets += neighbor[1]
-            mean_neighbor_targets = sum_neighbor_targets / self.k
-            return mean_neighbor_targets
+        y_pred: 1d array of targets predicted for each datapoint
+        """
+        raise NotImplementedError
 
     def predict(self, X_test):
         """
@@ -271,21 +560,116 @@ class MyKNeighborsRegressor:
         _______
         y_pred: 1d array of targets predicted for each datapoint
         """
-        y_pred = []
-        for unknown_datapoint in X_test:
-            predicted_target = self.predict_single_datapoint(unknown_datapoint)
-            y_pred.append(predicted_target)
-        return np.array(y_pred)
-
-
+        neighbors_squared_distances, neighbor_indices = self._kneighbors(X_test)
+        y_pred = self._aggregate(self.y_train[neighbor_indices], neighbors_squared_distances)
+        return y_pred
 
 
+class MyKNeighborsClassifier(_KNNBase):
+    """
+    Classifier that predicts the class of the unknown datapoint to be the most common class of its k nearest neighbors
 
+    Attributes
+    ----------
+    k : Number of nearest neighbors to use in the algorithm
+    X_train : 2d numpy array containing the features of all neighbors, where each row contains the features of a single neighbor
+    y_train : 1d numpy array containing the target of each neighbor
+    algorithm : How to search for the nearest neighbors. Either 'brute', 'kd_tree', 'ball_tree' or 'auto'.
+                'auto' uses a KD-tree when there are few features, and brute force otherwise.
+    n_jobs : Number of threads used to search for the nearest neighbors in predict. -1 means all cores.
+             While the brute-force search runs on several threads, BLAS is limited to one thread each
+             (if threadpoolctl is installed), so that the threads do not each start a full set of BLAS threads.
+             ball_tree ignores n_jobs, since sklearn's BallTree.query always runs on a single thread.
+    dtype : Floating point type X_train is stored in. np.float32 halves the memory used by X_train, but the features
+            (and so the distances) are rounded to float32 precision. The brute-force search still computes the distances
+            in float64, a block of datapoints at a time.
+    device : 'cpu', or a PyTorch device such as 'cuda'. On a GPU, predict runs the brute-force search with PyTorch
+             when both X_train and X_test have at least 512 rows (requires torch). The copy of X_train on the device
+             is always in float64.
+    """
+    def __init__(self, k=5, algorithm='auto', n_jobs=-1, dtype=np.float64, device='cpu'):
+        super().__init__(k=k, algorithm=algorithm, n_jobs=n_jobs, dtype=dtype, device=device)
 
+    def _aggregate(self, neighbors_targets, neighbors_squared_distances):
+        """
+        Predicts the class of each datapoint to be the most common class among its k nearest neighbors.
+        The votes of all datapoints are counted together, by comparing the classes of their neighbors pairwise. This takes
+        O(k^2) memory per datapoint whatever the number of classes, and works with any labels that support ==
+        (e.g. a mix of numbers and strings).
 
+        Parameters
+        __________
+        neighbors_targets: 2d matrix with the classes of the k nearest neighbors of each datapoint
+        neighbors_squared_distances: 2d matrix with the squared distances to the k nearest neighbors of each datapoint
 
+        Returns
+        _______
+        y_pred: 1d array of classes predicted for each datapoint
+        """
+        num_datapoints = neighbors_targets.shape[0]
+        # Order each datapoint's neighbors from nearest to farthest, so that ties in the vote go to the nearest neighbor.
+        order = np.argsort(neighbors_squared_distances, axis=1, kind='stable')
+        neighbors_targets = np.take_along_axis(neighbors_targets, order, axis=1)
+        # neighbor_counts[i, j] is how many neighbors of datapoint i share the class of its neighbor j.
+        # argmax returns the first of the maximums, which is the nearest neighbor of the most common class.
+        neighbor_counts = (neighbors_targets[:, :, None] == neighbors_targets[:, None, :]).sum(axis=2)
+        most_common_neighbors = np.argmax(neighbor_counts, axis=1)
+        y_pred = neighbors_targets[np.arange(num_datapoints), most_common_neighbors]
+        return y_pred
+
+
+class MyKNeighborsRegressor(_KNNBase):
+    """
+    Regression model that predicts the target of the unknown datapoint to be the average target of its k nearest neighbors
 
+    Attributes
+    ----------
+    k : Number of nearest neighbors to use in the algorithm.
+    X_train : 2d numpy array containing the features of all neighbors, where each row contains the features of a single neighbor.
+    y_train : 1d numpy array containing the target of each neighbor.
+    weighted: Indicated whether or not we will compute the weighted average of the k neighbors or just the regular mean of
+              the k neighbors.
+    algorithm : How to search for the nearest neighbors. Either 'brute', 'kd_tree', 'ball_tree' or 'auto'.
+                'auto' uses a KD-tree when there are few features, and brute force otherwise.
+    n_jobs : Number of threads used to search for the nearest neighbors in predict. -1 means all cores.
+             While the brute-force search runs on several threads, BLAS is limited to one thread each
+             (if threadpoolctl is installed), so that the threads do not each start a full set of BLAS threads.
+             ball_tree ignores n_jobs, since sklearn's BallTree.query always runs on a single thread.
+    dtype : Floating point type X_train is stored in. np.float32 halves the memory used by X_train, but the features
+            (and so the distances) are rounded to float32 precision. The brute-force search still computes the distances
+            in float64, a block of datapoints at a time.
+    device : 'cpu', or a PyTorch device such as 'cuda'. On a GPU, predict runs the brute-force search with PyTorch
+             when both X_train and X_test have at least 512 rows (requires torch). The copy of X_train on the device
+             is always in float64.
+    """
 
+    def __init__(self, k=5, weighted=True, algorithm='auto', n_jobs=-1, dtype=np.float64, device='cpu'):
+        super().__init__(k=k, algorithm=algorithm, n_jobs=n_jobs, dtype=dtype, device=device)
+        self.weighted = weighted
 
+    def _aggregate(self, neighbors_targets, neighbors_squared_distances):
+        """
+        Predicts the target of each datapoint to be the (weighted) average target of its k nearest neighbors.
 
+        Parameters
+        __________
+        neighbors_targets: 2d matrix with the targets of the k nearest neighbors of each datapoint
+        neighbors_squared_distances: 2d matrix with the squared distances to the k nearest neighbors of each datapoint
 
+        Returns
+        _______
+        y_pred: 1d array of targets predicted for each datapoint
+        """
+        if self.weighted:
+            # Only the k selected distances need the square root
+            neighbors_distances = np.sqrt(neighbors_squared_distances)
+            with np.errstate(divide='ignore'):
+                weights = 1.0 / neighbors_distances
+            # A neighbor at distance 0 would get an infinite weight, so in those rows only the exact matches count
+            exact_matches = neighbors_distances == 0
+            rows_with_matches = exact_matches.any(axis=1)
+            weights[rows_with_matches] = exact_matches[rows_with_matches]
+            y_pred = (neighbors_targets * weights).sum(axis=1) / weights.sum(axis=1)
+        else:
+            y_pred = neighbors_targets.mean(axis=1)
+        return y_pred
@@ -0,0 +1,36 @@
+import pandas as pd
+import numpy as np
+from sklearn.model_selection import train_test_split
+from KNearestNeighbors import MyKNeighborsClassifier
+
+dataframe = pd.read_csv("data.csv")
+X = dataframe[['feature1', 'feature2', 'feature3']].values
+y = dataframe['target'].values
+X_train, X_test, y_train, y_test = train_test_split(X, y, random_state=0)
+k = 3
+
+# Every search algorithm should find the same neighbors, so the predictions should match
+y_preds = []
+for algorithm in ['brute', 'kd_tree', 'ball_tree']:
+  model = MyKNeighborsClassifier(k=k, algorithm=algorithm)
+  model.fit(X_train, y_train)
+  y_preds.append(model.predict(X_test))
+
+# The only exception is when several training datapoints are tied for the k-th nearest neighbor:
+# each algorithm may then pick a different one of them.
+num_different = 0
+for i, (unknown, a, b, c) in enumerate(zip(X_test, *y_preds)):
+  if a == b == c:
+    continue
+  squared_distances = np.sort(((X_train - unknown) ** 2).sum(axis=1))
+  tied = np.isclose(squared_distances[k - 1], squared_distances[k], rtol=1e-9, atol=0)
+  print("row", i, "brute:", a, "kd_tree:", b, "ball_tree:", c, "(tie at the k-th neighbor)" if tied else "")
+  if not tied:
+    num_different += 1
+print("predictions that differ without a tie:", num_different)
+
+# Predicting no datapoints at all should give an empty prediction with every algorithm
+for algorithm in ['brute', 'kd_tree', 'ball_tree']:
+  model = MyKNeighborsClassifier(k=k, algorithm=algorithm)
+  model.fit(X_train, y_train)
+  print(algorithm, "prediction for an empty X_test:", model.predict(X_test[:0]))
@@ -0,0 +1,25 @@
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import MinMaxScaler
+from KNearestNeighbors import MyKNeighborsRegressor
+
+dataframe = pd.read_csv("data.csv")
+# Put the features on very different scales, so that normalizing actually matters
+X = dataframe[['feature1', 'feature2', 'feature3']].values * [1000, 1, 50]
+y = dataframe['target'].values
+X_train, X_test, y_train, y_test = train_test_split(X, y, random_state=0)
+
+# 1) Normalize with sklearn before fitting, using the training data's min and max for both sets
+scaler = MinMaxScaler()
+scaler.fit(X_train)
+model = MyKNeighborsRegressor(k=3, weighted=False)
+model.fit(scaler.transform(X_train), y_train)
+y_pred_sklearn = model.predict(scaler.transform(X_test))
+
+# 2) Let fit normalize the data itself
+model = MyKNeighborsRegressor(k=3, weighted=False)
+model.fit(X_train, y_train, normalize=True)
+y_pred_me = model.predict(X_test)
+
+for a, b in zip(y_pred_me, y_pred_sklearn):
+  print(a, b)
@@ -0,0 +1,30 @@
+import pandas as pd
+import numpy as np
+from sklearn.model_selection import train_test_split
+from KNearestNeighbors import MyKNeighborsRegressor
+
+dataframe = pd.read_csv("data.csv")
+X = dataframe[['feature1', 'feature2', 'feature3']].values
+y = dataframe['target'].values
+X_train, X_test, y_train, y_test = train_test_split(X, y, random_state=0)
+
+# The same brute-force model, once with the training data stored in float64 and once in float32
+model = MyKNeighborsRegressor(k=3, weighted=True, algorithm='brute', dtype=np.float64)
+model.fit(X_train, y_train)
+y_pred_float64 = model.predict(X_test)
+
+model = MyKNeighborsRegressor(k=3, weighted=True, algorithm='brute', dtype=np.float32)
+model.fit(X_train, y_train)
+y_pred_float32 = model.predict(X_test)
+
+for a, b in zip(y_pred_float32, y_pred_float64):
+  print(a, b)
+
+# float32 only rounds the distances, so the predictions should only differ where the k-th nearest neighbor is tied
+num_different = 0
+for unknown, a, b in zip(X_test, y_pred_float32, y_pred_float64):
+  squared_distances = np.sort(((X_train - unknown) ** 2).sum(axis=1))
+  tied = np.isclose(squared_distances[2], squared_distances[3], rtol=1e-6, atol=0)
+  if abs(a - b) > 1e-4 and not tied:
+    num_different += 1
+print("predictions that differ by more than 1e-4 without a tie:", num_different)
@@ -0,0 +1,35 @@
+import pandas as pd
+import numpy as np
+import torch
+from sklearn.model_selection import train_test_split
+from KNearestNeighbors import MyKNeighborsRegressor
+
+dataframe = pd.read_csv("data.csv")
+X = dataframe[['feature1', 'feature2', 'feature3']].values
+y = dataframe['target'].values
+X_train, X_test, y_train, y_test = train_test_split(X, y, random_state=0)
+
+# The PyTorch search only runs when a device other than 'cpu' is given, but torch.device('cpu') is one,
+# so this runs the same code as on a GPU, without needing one.
+# Both X_train and X_test have more than 512 rows, so predict does use it.
+for dtype in [np.float64, np.float32]:
+  model = MyKNeighborsRegressor(k=3, weighted=True, device=torch.device('cpu'), dtype=dtype)
+  model.fit(X_train, y_train)
+  y_pred_torch = model.predict(X_test)
+
+  model = MyKNeighborsRegressor(k=3, weighted=True, algorithm='brute', dtype=dtype)
+  model.fit(X_train, y_train)
+  y_pred_brute = model.predict(X_test)
+
+  for a, b in zip(y_pred_torch, y_pred_brute):
+    print(a, b)
+
+  # Both recompute the distances to the neighbors they select exactly,
+  # so the predictions should only differ where the k-th nearest neighbor is tied
+  num_different = 0
+  for unknown, a, b in zip(X_test, y_pred_torch, y_pred_brute):
+    squared_distances = np.sort(((X_train - unknown) ** 2).sum(axis=1))
+    tied = np.isclose(squared_distances[2], squared_distances[3], rtol=1e-6, atol=0)
+    if abs(a - b) > 1e-9 and not tied:
+      num_different += 1
+  print(np.dtype(dtype).name, "predictions that differ by more than 1e-9 without a tie:", num_different)
@@ -0,0 +1,34 @@
+import pandas as pd
+import numpy as np
+from sklearn.model_selection import train_test_split
+import KNearestNeighbors
+from KNearestNeighbors import MyKNeighborsRegressor
+
+dataframe = pd.read_csv("data.csv")
+X = dataframe[['feature1', 'feature2', 'feature3']].values
+y = dataframe['target'].values
+X_train, X_test, y_train, y_test = train_test_split(X, y, random_state=0)
+
+model = MyKNeighborsRegressor(k=3, weighted=True, algorithm='brute')
+model.fit(X_train, y_train)
+if model._kneighbors_kernel is None:
+  print("numba is not installed, both predictions use the blocked brute-force search")
+
+# The same brute-force model, once through the numba kernel and once through the blocked search,
+# by changing the number of features up to which the numba kernel is used
+KNearestNeighbors._NUMBA_MAX_FEATURES = X.shape[1]
+y_pred_numba = model.predict(X_test)
+KNearestNeighbors._NUMBA_MAX_FEATURES = 0
+y_pred_blocked = model.predict(X_test)
+
+for a, b in zip(y_pred_numba, y_pred_blocked):
+  print(a, b)
+
+# Both compute exact distances, so the predictions should only differ where the k-th nearest neighbor is tied
+num_different = 0
+for unknown, a, b in zip(X_test, y_pred_numba, y_pred_blocked):
+  squared_distances = np.sort(((X_train - unknown) ** 2).sum(axis=1))
+  tied = np.isclose(squared_distances[2], squared_distances[3], rtol=1e-9, atol=0)
+  if abs(a - b) > 1e-9 and not tied:
+    num_different += 1
+print("predictions that differ by more than 1e-9 without a tie:", num_different)